@@ -1,11 +1,13 @@
+import asyncio
 import json
 import logging
 import os
-import time
+import re
 import typing
 from abc import ABC, abstractmethod
-from math import ceil
 
+import aiofiles
+import aiohttp
 import requests
 from bs4 import BeautifulSoup
 from dotenv import load_dotenv
@@ -22,8 +24,21 @@ stream_handler.setFormatter(formatter)
 if os.environ.get("ENABLE_LOGGING", True):
     logger.addHandler(stream_handler)
 
+# Translation table that drops newlines, tabs and carriage returns
+_STRIP_TABLE = str.maketrans("", "", "\n\t\r")
+
+# Alert card text, e.g. "FIRE ALERT! -> BRGY X, QUEZON CITY: 1ST ALARM"
+_ALERT_INFO_RE = re.compile(
+    r"^\s*(?:FIRE ALERT!)?\s*(?:->)?\s*(?P<info>[^:]*?)\s*(?::\s*(?P<type>.*?))?\s*$"
+)
+# Alert card time, e.g. "As of 10/14/2024 10:00 AM"
+_ALERT_TIME_RE = re.compile(r"As of\s+(?P<when>.+?)\s*$")
+
 
 class Notifier(ABC):
+    # Longest message the service accepts, None when unlimited
+    max_message_length: typing.Optional[int] = None
+
     @abstractmethod
     def send_message(self, message: str):
         raise NotImplementedError("Please Implement this method")
@@ -39,6 +54,7 @@ class PushoverNotifier(Notifier):
     )
 
     notifier_name = "Pushover"
+    max_message_length = 1024
 
     def __init__(
         self,
@@ -51,6 +67,7 @@ class PushoverNotifier(Notifier):
         self.user = user
         self.endpoint = endpoint
         self.device = device
+        self._session = requests.Session()
 
         assert self.token, (
             "Please set Pushover Token! "
@@ -61,13 +78,14 @@ class PushoverNotifier(Notifier):
             "(Hint: Set PUSHOVER_USER environment variable)"
         )
 
-        logger.debug("=" * 70)
-        logger.debug("Pushover Configurations")
-        logger.debug(f"Token: {self.mask_secret(self.token)}")
-        logger.debug(f"User: {self.mask_secret(self.user)}")
-        logger.debug(f"Device: {self.mask_secret(self.device)}")
-        logger.debug(f"Endpoint: {self.endpoint}")
-        logger.debug("=" * 70)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("=" * 70)
+            logger.debug("Pushover Configurations")
+            logger.debug("Token: %s", self.mask_secret(self.token))
+            logger.debug("User: %s", self.mask_secret(self.user))
+            logger.debug("Device: %s", self.mask_secret(self.device))
+            logger.debug("Endpoint: %s", self.endpoint)
+            logger.debug("=" * 70)
 
     def send_message(
         self,
@@ -92,47 +110,52 @@ class PushoverNotifier(Notifier):
         }
 
         try:
-            response = requests.post(url, data=data)
+            response = self._session.post(url, data=data)
             return response
         except Exception as e:
-            logger.error(f"Failed to send pushover message! {e}")
+            logger.error("Failed to send pushover message! %s", e)
             return None
 
     @staticmethod
     def mask_secret(secret: str) -> str:
+        # Mask 70% of the secret and keep ceil(20%) / ceil(10%) of the mask
+        # length visible at the start / end, using integer math only
         secret_len = len(secret)
-        mask_len = int(secret_len * 0.7)
-        start_mask_len = ceil(mask_len * 0.2)
-        end_mask_len = ceil(mask_len * 0.1)
+        mask_len = secret_len * 7 // 10
+        start_mask_len = -(-mask_len * 2 // 10)
+        end_mask_len = -(-mask_len // 10)
         first_part_secret = secret[:start_mask_len]
-        last_part_secret = secret[-end_mask_len:]
+        last_part_secret = secret[secret_len - end_mask_len :] if end_mask_len else ""
         mask = "*" * mask_len
 
         return f"{first_part_secret}{mask}{last_part_secret}"
 
 
 class FireNotifierHelper:
-    @staticmethod
-    def split_and_capitalize_text(text: str) -> typing.List[str]:
-        text_split = text.split(",")
-        text = [term.strip().capitalize() for term in text_split]
-        return text
-
     @staticmethod
     def capitalize_per_word(text: str) -> str:
         return " ".join([word.capitalize() for word in text.split()])
 
     @staticmethod
     def clean_text(text: str) -> str:
-        return text.strip().replace("\n", "").replace("\t", "").replace("\r", "")
+        return text.translate(_STRIP_TABLE).strip()
 
 
 class FireNotifier:
     USER_AGENT = "https://github.com/nulldot0/fire-notifier"
 
     # Website: https://txtfire.net
-    # Source Data URL
-    TARGET_URL = "https://id.txtfire.net/qqq3"
+    # Source Data URLs, one per region (comma separated)
+    TARGET_URLS = [
+        url.strip()
+        for url in os.environ.get(
+            "TARGET_URLS", "https://id.txtfire.net/qqq3"
+        ).split(",")
+        if url.strip()
+    ]
+
+    # Upper bound of the polling delay while no new alerts come in
+    MAX_DELAY_MULTIPLIER = 16
 
     # Alert Types
     FIRST_ALARM = "1ST ALARM"
@@ -158,46 +181,88 @@ class FireNotifier:
     MATRESS_FIRE = "MATRESS FIRE"
 
     # Alarm Types that are considered dangerous
-    WARN_ALARMS = [
-        FIRST_ALARM,
-        SECOND_ALARM,
-        THIRD_ALARM,
-        FOURTH_ALARM,
-        FIFTH_ALARM,
-        POSSITIVE_ALARM,
-        GAS_STOVE_FIRE,
-        ELECTRICAL_FIRE,
-        VEHICULAR_FIRE,
-        RUBBISH_FIRE,
-        CEILING_FIRE,
-        VISIBLE_SMOKE,
-        POSITIVE_ALARM,
-        POST_FIRE,
-        KITCHEN_FIRE,
-        MATRESS_FIRE,
-        FOR_VERIFICATION,  # Consider as dangerous
-    ]
+    WARN_ALARMS = frozenset(
+        [
+            FIRST_ALARM,
+            SECOND_ALARM,
+            THIRD_ALARM,
+            FOURTH_ALARM,
+            FIFTH_ALARM,
+            POSSITIVE_ALARM,
+            GAS_STOVE_FIRE,
+            ELECTRICAL_FIRE,
+            VEHICULAR_FIRE,
+            RUBBISH_FIRE,
+            CEILING_FIRE,
+            VISIBLE_SMOKE,
+            POSITIVE_ALARM,
+            POST_FIRE,
+            KITCHEN_FIRE,
+            MATRESS_FIRE,
+            FOR_VERIFICATION,  # Consider as dangerous
+        ]
+    )
 
     def __init__(
         self,
         search_term: str,
         delay: int,
-        json_db_filename: str = "fire_alerts.json",
+        json_db_filename: str = "fire_alerts.jsonl",
         json_db_path: str = "db",
         notifier_type: str = "pushover",
         notifier: Notifier = None,
     ):
         self.search_term = search_term
+        self._search_terms_lower: typing.Tuple[str, ...] = tuple(
+            term.strip().lower()
+            for term in (search_term or "").split(",")
+            if term.strip()
+        )
         self.delay = delay
         self.json_db_filename = json_db_filename
-        self.json_db_path = os.path.join(json_db_path, json_db_filename)
+        # Alerts are stored as JSON Lines; older `.json` list DBs get migrated
+        json_db_root, _ = os.path.splitext(
+            os.path.join(json_db_path, json_db_filename)
+        )
+        self.json_db_path = f"{json_db_root}.jsonl"
+        legacy_json_db_path = f"{json_db_root}.json"
+        self._session: typing.Optional[aiohttp.ClientSession] = None
+
+        # Validators for conditional GETs, keyed by source data URL
+        self._etags: typing.Dict[str, str] = {}
+        self._last_modified: typing.Dict[str, str] = {}
+        self._last_alerts: typing.Dict[str, typing.List[dict]] = {}
 
         if not os.path.exists(json_db_path):
             os.makedirs(json_db_path)
 
         if not os.path.exists(self.json_db_path):
-            with open(self.json_db_path, "w") as f:
-                json.dump([], f, indent=4)
+            if os.path.exists(legacy_json_db_path):
+                self.migrate_legacy_json_db(legacy_json_db_path)
+            else:
+                open(self.json_db_path, "w").close()
+
+        self._seen_alerts: typing.Set[typing.Tuple[str, str, str]] = set()
+        line = ""
+        with open(self.json_db_path, "r") as f:
+            for line_number, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    alert = json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning(
+                        "Skipping unreadable line %s in %s",
+                        line_number,
+                        self.json_db_path,
+                    )
+                    continue
+                self._seen_alerts.add(self.alert_key(alert))
+
+        # Terminate a torn last line so the next append starts on its own line
+        if line and not line.endswith("\n"):
+            with open(self.json_db_path, "a") as f:
+                f.write("\n")
 
         if notifier and notifier_type:
             logger.warning(
@@ -212,121 +277,267 @@ class FireNotifier:
 
         logger.debug("=" * 70)
         logger.debug("Configurations")
-        logger.debug(f"Search Term/s: {search_term}")
-        logger.debug(f"Delay: {delay} seconds")
-        logger.debug(f"JSON DB Filename: {json_db_filename}")
-        logger.debug(f"JSON DB Path: {self.json_db_path}")
-        logger.debug(f"Notifier Type: {self.notifier.notifier_name}")
+        logger.debug("Search Term/s: %s", search_term)
+        logger.debug("Delay: %s seconds", delay)
+        logger.debug("JSON DB Filename: %s", json_db_filename)
+        logger.debug("JSON DB Path: %s", self.json_db_path)
+        logger.debug("Notifier Type: %s", self.notifier.notifier_name)
         logger.debug("=" * 70)
 
+    def migrate_legacy_json_db(self, legacy_json_db_path: str) -> None:
+        logger.info("Migrating %s to %s", legacy_json_db_path, self.json_db_path)
+        with open(legacy_json_db_path, "r") as f:
+            data = json.load(f)
+
+        # Write next to the target and swap it in, so an interrupted
+        # migration never leaves a partial DB that would be picked up
+        tmp_json_db_path = f"{self.json_db_path}.tmp"
+        with open(tmp_json_db_path, "w") as f:
+            for alert in data:
+                f.write(json.dumps(alert) + "\n")
+
+        os.replace(tmp_json_db_path, self.json_db_path)
+
     def set_default_notifier(self, notifier_type: str):
         if notifier_type == "pushover":
             self.notifier = PushoverNotifier()
         else:
             raise ValueError(f"Notifier type {notifier_type} not supported!")
 
-    def start(self):
+    async def start(self):
+        self._session = aiohttp.ClientSession(headers={"User-Agent": self.USER_AGENT})
+        try:
+            # Alerts listed before start-up are not notified, see baseline_fire_alerts
+            for url, alerts in (await self.get_fire_alerts()).items():
+                self.baseline_fire_alerts(url, alerts)
+
+            await self._poll()
+        finally:
+            await self._session.close()
+            self._session = None
+
+    async def _poll(self):
+        # Back off while the feed is quiet, reset once a new alert shows up
+        interval = self.delay
+        max_interval = self.delay * self.MAX_DELAY_MULTIPLIER
+        last_alert_keys: typing.Set[typing.Tuple[str, str, str]] = set()
+
         while True:
-            time.sleep(self.delay)
-            fire_alerts = self.get_fire_alerts()
-            if not fire_alerts:
-                logger.warning("No fire alerts found!")
-                continue
+            alerts_by_url = await self.get_fire_alerts()
+            all_sent = await self.notify_fire_alerts(alerts_by_url)
+
+            # A failed fetch returns nothing, keep the previous page to compare to
+            alert_keys = {
+                self.alert_key(alert)
+                for alerts in alerts_by_url.values()
+                for alert in alerts
+            }
+            # Unsent alerts are retried at the base delay until they go out
+            if not all_sent or alert_keys - last_alert_keys:
+                interval = self.delay
+            else:
+                interval = min(interval * 2, max_interval)
+            if alert_keys:
+                last_alert_keys = alert_keys
+            logger.debug("Next check in %s seconds", interval)
+
+            await asyncio.sleep(interval)
+
+    async def notify_fire_alerts(
+        self, alerts_by_url: typing.Dict[str, typing.List[dict]]
+    ) -> bool:
+        # Returns False when some notifiable alert could not be sent
+        if not any(alerts_by_url.values()):
+            logger.warning("No fire alerts found!")
+            return True
+
+        # Pages list the newest alert first, notify in chronological order
+        # The same card can be listed twice, or on more than one region page
+        batch = []
+        batch_keys: typing.Set[typing.Tuple[str, str, str]] = set()
+        for alerts in alerts_by_url.values():
+            for fire_alert in reversed(alerts):
+                alert_key = self.alert_key(fire_alert)
+                if alert_key in batch_keys:
+                    continue
+                if self.is_alert_notifiable(fire_alert):
+                    batch.append(fire_alert)
+                    batch_keys.add(alert_key)
 
-            recent_fire_alert = fire_alerts[0]
-            alert_type = recent_fire_alert["alert_type"]
-            alert_info = recent_fire_alert["alert_info"]
-            alert_time = recent_fire_alert["alert_time"]
+        if not batch:
+            logger.info("No new fire alerts to notify!")
+            return True
 
-            alert_type_clean = FireNotifierHelper.capitalize_per_word(alert_type)
-            alert_info_clean = FireNotifierHelper.capitalize_per_word(alert_info)
+        all_sent = True
+        for notification_message, alerts in self.build_notification_messages(batch):
+            response = self.notifier.send_message(notification_message)
+
+            if response and response.ok:
+                logger.info("Notified! %s fire alert/s", len(alerts))
+                for alert in alerts:
+                    await self.add_fire_alert_to_db(alert)
+            else:
+                logger.warning(
+                    "Failed to send notification! %s",
+                    response.text if response is not None else "",
+                )
+                all_sent = False
+
+        return all_sent
+
+    def baseline_fire_alerts(self, url: str, alerts: typing.List[dict]) -> None:
+        # Only the alerts listed above the newest one already in the DB are
+        # new. Everything else, or the whole page when none of it is in the DB
+        # (fresh install, DB without a volume), is marked as seen in memory
+        # without notifying.
+        new_alert_count = 0
+        for index, alert in enumerate(alerts):
+            if self.check_fire_alert_in_db(alert):
+                new_alert_count = index
+                break
+
+        for alert in alerts[new_alert_count:]:
+            self._seen_alerts.add(self.alert_key(alert))
+
+        logger.info(
+            "Skipping %s fire alert/s listed on %s before start-up",
+            len(alerts) - new_alert_count,
+            url,
+        )
 
-            logger.info(
-                f"Recent Fire Alert: {alert_type_clean} "
-                f"from {alert_info_clean} on {alert_time}"
+    def is_alert_notifiable(self, alert_data: dict) -> bool:
+        alert_type = alert_data["alert_type"]
+        alert_info = alert_data["alert_info"]
+        alert_time = alert_data["alert_time"]
+
+        if self.check_fire_alert_in_db(alert_data):
+            logger.debug(
+                "Alert %s from %s on %s already sent!",
+                alert_type,
+                alert_info,
+                alert_time,
             )
+            return False
 
-            if not self.is_match_found_in_alert_info(alert_info):
-                search_terms = FireNotifierHelper.split_and_capitalize_text(
-                    self.search_term
-                )
-                search_terms_readable = ", ".join(search_terms)
-                if len(search_terms) > 1:
-                    logger.info(
-                        f"Search terms `{search_terms_readable}` not found in {alert_info}!"
-                    )
-                    continue
+        if alert_type not in self.WARN_ALARMS:
+            logger.debug("Alert type %s is not dangerous!", alert_type)
+            return False
 
-                search_term = search_terms[0].capitalize()
-                logger.info(f"Search term '{search_term}' not found in {alert_info}!")
-                continue
+        if not self.is_match_found_in_alert_info(alert_info):
+            logger.debug(
+                "Search term/s `%s` not found in %s!",
+                ", ".join(term.capitalize() for term in self._search_terms_lower),
+                alert_info,
+            )
+            return False
 
-            if alert_type not in self.WARN_ALARMS:
-                logger.info(f"Alert type {alert_type_clean} is not dangerous!")
-                continue
+        logger.info(
+            "New Fire Alert: %s from %s on %s", alert_type, alert_info, alert_time
+        )
+        return True
+
+    def build_notification_messages(
+        self, alerts: typing.List[dict]
+    ) -> typing.List[typing.Tuple[str, typing.List[dict]]]:
+        # Coalesce alerts into as few messages as the notifier allows
+        max_length = self.notifier.max_message_length
+        messages = []
+        chunk_entries: typing.List[str] = []
+        chunk_alerts: typing.List[dict] = []
+        chunk_length = 0
+
+        for alert in alerts:
+            alert_type_clean = FireNotifierHelper.capitalize_per_word(
+                alert["alert_type"]
+            )
+            alert_info_clean = FireNotifierHelper.capitalize_per_word(
+                alert["alert_info"]
+            )
+            alert_time = alert["alert_time"]
+            entry = f"{alert_type_clean}\n{alert_info_clean}\n{alert_time}"
 
-            if self.check_fire_alert_in_db(recent_fire_alert):
-                logger.info(
-                    f"Alert {alert_type_clean} "
-                    f"from {alert_info_clean} on {alert_time} already sent!"
-                )
+            # Entries are separated by a blank line ("\n\n")
+            new_length = chunk_length + len(entry) + (2 if chunk_entries else 0)
+            if chunk_entries and max_length and new_length > max_length:
+                messages.append(("\n\n".join(chunk_entries), chunk_alerts))
+                chunk_entries, chunk_alerts = [], []
+                new_length = len(entry)
+
+            chunk_entries.append(entry)
+            chunk_alerts.append(alert)
+            chunk_length = new_length
+
+        if chunk_entries:
+            messages.append(("\n\n".join(chunk_entries), chunk_alerts))
+
+        return messages
+
+    async def get_fire_alerts(self) -> typing.Dict[str, typing.List[dict]]:
+        results = await asyncio.gather(
+            *(self._fetch_one(url) for url in self.TARGET_URLS),
+            return_exceptions=True,
+        )
+
+        # One broken region page should not stop the others, failed regions
+        # are left out of the result
+        data = {}
+        for url, alerts in zip(self.TARGET_URLS, results):
+            if isinstance(alerts, Exception):
+                logger.warning("Failed to parse fire alerts from %s! %s", url, alerts)
                 continue
+            if alerts is not None:
+                data[url] = alerts
 
-            notification_message = (
-                f"{alert_type_clean}\n{alert_info_clean}\n{alert_time}"
-            )
-            response = self.notifier.send_message(notification_message)
+        return data
 
-            if response and response.ok:
-                logger.info(
-                    f"Notified! {alert_type_clean} "
-                    f"from {alert_info_clean} on {alert_time}"
-                )
-                self.add_fire_alert_to_db(recent_fire_alert)
-            else:
-                logger.warning(f"Failed to send notification! {response.text}")
+    async def _fetch_one(self, url: str) -> typing.Optional[typing.List[dict]]:
+        headers = {}
+        if url in self._etags:
+            headers["If-None-Match"] = self._etags[url]
+        if url in self._last_modified:
+            headers["If-Modified-Since"] = self._last_modified[url]
 
-    def get_fire_alerts(self) -> typing.List[dict]:
         try:
-            response = requests.get(
-                self.TARGET_URL, headers={"User-Agent": self.USER_AGENT}
-            )
+            async with self._session.get(url, headers=headers) as response:
+                content = await response.read()
         except Exception as e:
-            logger.warning(f"Failed to get response from {self.TARGET_URL}! {e}")
-            return []
+            logger.warning("Failed to get response from %s! %s", url, e)
+            return None
+
+        if response.status == 304:
+            logger.debug("%s not modified, using cached alerts", url)
+            return self._last_alerts.get(url, [])
 
         if not response.ok:
             logger.warning(
-                f"Failed to get response from {self.TARGET_URL}! {response.text}"
+                "Failed to get response from %s! %s",
+                url,
+                content.decode(errors="replace"),
             )
-            return []
+            return None
 
-        soup = BeautifulSoup(response.text, "html.parser")
+        soup = BeautifulSoup(content, "lxml")
         fire_alerts = soup.find_all("div", class_="cardfire")
 
         data = []
         for fire_alert in fire_alerts:
+            fire_alert_paragraphs = fire_alert.find_all("p", limit=2)
+            if len(fire_alert_paragraphs) < 2:
+                logger.warning("Skipping malformed fire alert card from %s", url)
+                continue
+
             fire_alert_info = FireNotifierHelper.clean_text(
-                fire_alert.find_all("p")[0].text
+                fire_alert_paragraphs[0].text
             )
-            fire_alert_info = fire_alert_info.replace("->", "")
-            fire_alert_parts = fire_alert_info.split(":")
-            alert_info = fire_alert_parts[0].strip()
-
-            alert_type = "UNKNOWN"
-            if len(fire_alert_parts) == 2:
-                alert_info = fire_alert_parts[0].split("!")[1]
-                alert_type = fire_alert_parts[1]
+            info_match = _ALERT_INFO_RE.match(fire_alert_info)
+            alert_info = info_match.group("info").replace("->", "").strip()
+            alert_type = (info_match.group("type") or "UNKNOWN").strip()
 
             fire_alert_time = FireNotifierHelper.clean_text(
-                fire_alert.find_all("p")[1].text
+                fire_alert_paragraphs[1].text
             )
-            fire_alert_time = fire_alert_time.split("As of ")[1]
-
-            alert_info = alert_info.strip()
-            alert_info = alert_info.replace("FIRE ALERT!", "")
-            alert_type = alert_type.strip()
-            alert_time = fire_alert_time.strip()
+            time_match = _ALERT_TIME_RE.search(fire_alert_time)
+            alert_time = time_match.group("when") if time_match else fire_alert_time
 
             data.append(
                 {
@@ -336,47 +547,54 @@ class FireNotifier:
                 }
             )
 
+        for validators, header in (
+            (self._etags, "ETag"),
+            (self._last_modified, "Last-Modified"),
+        ):
+            if header in response.headers:
+                validators[url] = response.headers[header]
+            else:
+                validators.pop(url, None)
+        self._last_alerts[url] = data
+
         return data
 
     def is_match_found_in_alert_info(self, alert_info: str) -> bool:
-        search_terms = FireNotifierHelper.split_and_capitalize_text(self.search_term)
+        if not self._search_terms_lower:
+            return True
 
-        for term in search_terms:
-            if term.lower() in alert_info.strip().lower():
-                return True
+        alert_info_lower = alert_info.lower()
+        return any(term in alert_info_lower for term in self._search_terms_lower)
 
-        return False
+    @staticmethod
+    def alert_key(alert_data: dict) -> typing.Tuple[str, str, str]:
+        # Times only have minute resolution, so they are not unique on their own
+        return (
+            alert_data["alert_time"],
+            alert_data["alert_info"],
+            alert_data["alert_type"],
+        )
 
     def check_fire_alert_in_db(self, alert_data: dict) -> bool:
-        with open(self.json_db_path, "r") as f:
-            data = json.load(f)
-
-        for alert in data:
-            if alert["alert_time"] == alert_data["alert_time"]:
-                return True
-
-        return False
-
-    def add_fire_alert_to_db(self, alert_data: dict) -> None:
-        with open(self.json_db_path, "r") as f:
-            data = json.load(f)
+        return self.alert_key(alert_data) in self._seen_alerts
 
-        data.append(alert_data)
+    async def add_fire_alert_to_db(self, alert_data: dict) -> None:
+        self._seen_alerts.add(self.alert_key(alert_data))
 
-        with open(self.json_db_path, "w") as f:
-            json.dump(data, f, indent=4)
+        async with aiofiles.open(self.json_db_path, "a") as f:
+            await f.write(json.dumps(alert_data) + "\n")
 
 
 def main():
     SEARCH_TERM = os.environ.get("SEARCH_TERM", "")
     DELAY = int(os.environ.get("DELAY", 30))
-    JSON_DB_FILENAME = os.environ.get("JSON_DB_FILENAME", "fire_alerts.json")
+    JSON_DB_FILENAME = os.environ.get("JSON_DB_FILENAME", "fire_alerts.jsonl")
     fire_notifier = FireNotifier(
         search_term=SEARCH_TERM,
         delay=DELAY,
         json_db_filename=JSON_DB_FILENAME,
     )
-    fire_notifier.start()
+    asyncio.run(fire_notifier.start())
 
 
 if __name__ == "__main__":